@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """Extract and chunk clinical guide documents for KB ingestion."""
 
+import atexit
 import json
 import os
 import re
@@ -8,210 +9,479 @@ import subprocess
 import sys
 import tempfile
 import shutil
-import glob
-from typing import List, Tuple
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import IO, Iterator, List, Optional, Tuple, Union
 from zipfile import ZipFile
 from xml.etree import ElementTree as ET
 
+try:
+    import fitz  # PyMuPDF: optional in-process text extraction
+except ImportError:
+    fitz = None
+
 MAX_CHARS = 1200
 MIN_CHARS = 180
+# Pages whose text layer has fewer characters than this are sent to OCR.
+OCR_MIN_CHARS = 40
+
+# Preferred chunk break points, strongest first.
+_SPLIT_TOKENS = ("\n\n", "\n", ". ", "; ", ": ", ", ", " ")
+
+_RE_SPACES = re.compile(r"[ ]{2,}")
+_RE_NL_SP = re.compile(r"\n[ ]+")
+_RE_NLS = re.compile(r"\n{3,}")
+_RE_LEADING_WS = re.compile(r"\s*")
+
+# WordprocessingML namespace-qualified names used by extract_docx_pages.
+_W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+_P_TAG = f'{{{_W}}}p'
+_T_TAG = f'{{{_W}}}t'
+_BR_TAG = f'{{{_W}}}br'
+_TYPE_ATTR = f'{{{_W}}}type'
+
+# Single-pass character normalization: CR becomes LF, tabs/NBSP and the
+# remaining C0 control characters become plain spaces.
+_CTRL_TABLE = {c: ord(" ") for c in list(range(0, 9)) + [11, 12] + list(range(14, 32))}
+_CTRL_TABLE.update({ord("\r"): ord("\n"), ord("\t"): ord(" "), 0xA0: ord(" ")})
 
 
-def load_metadata() -> dict:
-    raw = sys.stdin.read()
-    if not raw.strip():
+def _is_json(line: str) -> bool:
+    if not line.strip():
+        return False
+    try:
+        json.loads(line)
+    except json.JSONDecodeError:
+        return False
+    return True
+
+
+def load_metadata() -> Iterator[Union[dict, json.JSONDecodeError]]:
+    # One JSON object per line (NDJSON) lets a caller stream many documents
+    # through a single process; a lone JSON document, even one spread over
+    # several lines, is still accepted. A line that does not parse is yielded
+    # as its JSONDecodeError so the caller can report it and keep going.
+    first = ''
+    for line in sys.stdin:
+        if line.strip():
+            first = line
+            break
+    if not first:
         raise SystemExit("Missing metadata input")
     try:
-        return json.loads(raw)
+        meta = json.loads(first)
     except json.JSONDecodeError as exc:
-        raise SystemExit(f"Invalid metadata JSON: {exc}")
+        # Only fall back to one multi-line document when the first line opens
+        # a pretty-printed value or no later line is a document on its own;
+        # otherwise this is just a corrupt first line of an NDJSON stream.
+        rest = sys.stdin.readlines()
+        if first.strip() in ('{', '[') or not any(_is_json(line) for line in rest):
+            try:
+                yield json.loads(first + ''.join(rest))
+            except json.JSONDecodeError as doc_exc:
+                yield doc_exc
+            return
+        yield exc
+        lines = rest
+    else:
+        yield meta
+        lines = sys.stdin
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as exc:
+            yield exc
 
 
 def clean_text(value: str) -> str:
     if not value:
         return ""
-    text = value.replace("\r", "\n").replace("\t", " ")
-    text = text.replace("\u00a0", " ")
-    text = re.sub(r"[ ]{2,}", " ", text)
-    text = re.sub(r"\n[ ]+", "\n", text)
-    text = re.sub(r"\n{3,}", "\n\n", text)
-    text = re.sub(r"[\x00-\x08\x0b\x0c\x0e-\x1f]", " ", text)
+    text = value.translate(_CTRL_TABLE)
+    # Clean pdftotext pages rarely need every pass; a substring check is much
+    # cheaper than running a regex over the whole page for nothing.
+    if "  " in text:
+        text = _RE_SPACES.sub(" ", text)
+    if "\n " in text:
+        text = _RE_NL_SP.sub("\n", text)
+    if "\n\n\n" in text:
+        text = _RE_NLS.sub("\n\n", text)
     return text.strip()
 
 
-def find_split(segment: str) -> int:
-    tokens = ["\n\n", "\n", ". ", "; ", ": ", ", ", " "]
-    for token in tokens:
-        idx = segment.rfind(token, 0, MAX_CHARS)
-        if idx >= MIN_CHARS:
-            return idx + len(token)
+def find_split(segment: str, start: int = 0) -> int:
+    # Only the [MIN_CHARS, MAX_CHARS) window after ``start`` can hold a valid
+    # break, so each rfind stops scanning there instead of walking further back.
+    # The returned offset is relative to ``start``.
+    for token in _SPLIT_TOKENS:
+        idx = segment.rfind(token, start + MIN_CHARS, start + MAX_CHARS)
+        if idx >= 0:
+            return idx - start + len(token)
     return MAX_CHARS
 
 
-def chunk_pages(pages: List[str]) -> List[dict]:
-    chunks: List[dict] = []
+def chunk_pages(pages: List[str]) -> Iterator[dict]:
+    # Chunks are yielded as they are produced; the most recent one is held
+    # back because a short trailing remainder gets merged into it.
+    last: Optional[dict] = None
     chunk_index = 0
     carry = ""
     carry_page = None
+    # Scanned guides repeat the same header/footer-only pages many times;
+    # clean each distinct page once. Only pages that occur again later stay
+    # cached, and each entry is dropped after its last occurrence, so unique
+    # pages are released as soon as they are chunked.
+    remaining = Counter(pages)
+    cleaned: dict = {}
     for page_number, raw_page in enumerate(pages, start=1):
-        page_text = clean_text(raw_page)
+        page_text = cleaned.get(raw_page)
+        if page_text is None:
+            page_text = clean_text(raw_page)
+        remaining[raw_page] -= 1
+        if remaining[raw_page]:
+            cleaned[raw_page] = page_text
+        else:
+            cleaned.pop(raw_page, None)
         if not page_text:
             continue
         combined = page_text if not carry else f"{carry}\n\n{page_text}"
         page_for_chunk = carry_page if carry_page is not None else page_number
         carry = ""
         carry_page = None
+        # Walk the combined text with a cursor instead of re-slicing the
+        # remainder after every chunk.
         text = combined
-        while text:
-            if len(text) <= MAX_CHARS:
-                carry = text
+        pos = 0
+        while pos < len(text):
+            if len(text) - pos <= MAX_CHARS:
+                carry = text[pos:]
                 carry_page = page_for_chunk
                 break
-            head = text[:MAX_CHARS]
-            split_at = find_split(head)
-            piece = text[:split_at].strip()
-            text = text[split_at:].lstrip()
+            split_at = pos + find_split(text, pos)
+            piece = text[pos:split_at].strip()
+            pos = _RE_LEADING_WS.match(text, split_at).end()
             if not piece:
                 continue
-            if len(piece) < MIN_CHARS and text:
+            if len(piece) < MIN_CHARS and pos < len(text):
                 carry = piece
                 if carry_page is None:
                     carry_page = page_for_chunk
                 continue
             chunk_index += 1
-            chunks.append({
+            if last is not None:
+                yield last
+            last = {
                 "chunk_index": chunk_index,
                 "page_number": page_for_chunk,
                 "content": piece,
                 "status": "ok",
-            })
+            }
             page_for_chunk = page_number
         if carry and len(carry) >= MAX_CHARS:
             chunk_index += 1
-            chunks.append({
+            if last is not None:
+                yield last
+            last = {
                 "chunk_index": chunk_index,
                 "page_number": carry_page if carry_page is not None else page_number,
                 "content": carry.strip(),
                 "status": "ok",
-            })
+            }
             carry = ""
             carry_page = None
     if carry:
         carry_text = carry.strip()
         if carry_text:
-            if chunks and len(carry_text) < MIN_CHARS:
-                chunks[-1]["content"] = f"{chunks[-1]['content']}\n\n{carry_text}".strip()
+            if last is not None and len(carry_text) < MIN_CHARS:
+                last["content"] = f"{last['content']}\n\n{carry_text}".strip()
             else:
                 chunk_index += 1
-                chunks.append({
+                if last is not None:
+                    yield last
+                last = {
                     "chunk_index": chunk_index,
                     "page_number": carry_page if carry_page is not None else (len(pages) or 1),
                     "content": carry_text,
                     "status": "ok",
-                })
-    return chunks
+                }
+    if last is not None:
+        yield last
+
+
+def _error_detail(exc: subprocess.CalledProcessError) -> str:
+    # Subprocess output is captured as bytes; only the (bounded) stderr of a
+    # failed command is ever decoded.
+    return (exc.stderr or b'').decode('utf-8', errors='replace').strip()[:4096]
+
+
+def extract_pdf_text(path: str) -> Tuple[str, str, dict]:
+    # Returns the text layer with pages separated by form feeds, the extractor
+    # that produced it ('pymupdf' or 'pdftotext') and any extraction errors.
+    errors = {}
+    if fitz is not None:
+        try:
+            with fitz.open(path) as doc:
+                return '\f'.join(page.get_text('text') for page in doc), 'pymupdf', errors
+        except Exception as exc:
+            errors['pymupdf'] = f'pymupdf_failed: {exc}'
+    # pdftotext writes to a scratch file rather than a pipe, so large outputs
+    # are not pushed through the small pipe buffer a few KB at a time.
+    with tempfile.NamedTemporaryFile(suffix='.txt', delete=False) as tmp:
+        out_path = tmp.name
+    try:
+        try:
+            subprocess.run(
+                ['pdftotext', '-enc', 'UTF-8', '-layout', path, out_path],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=True,
+            )
+        except FileNotFoundError:
+            errors['pdftotext'] = 'pdftotext_not_found'
+            return '', 'pdftotext', errors
+        except subprocess.CalledProcessError as exc:
+            errors['pdftotext'] = 'pdftotext_failed'
+            detail = _error_detail(exc)
+            if detail:
+                errors['pdftotext_detail'] = detail
+        with open(out_path, 'rb') as handle:
+            text = handle.read().decode('utf-8', errors='replace')
+        # pdftotext ends every page with a form feed; drop the final one so
+        # that splitting on '\f' yields exactly one entry per page.
+        if text.endswith('\f'):
+            text = text[:-1]
+        return text, 'pdftotext', errors
+    finally:
+        os.unlink(out_path)
+
+
+def _ocr_workers() -> int:
+    try:
+        workers = int(os.environ.get('OCR_WORKERS') or 0)
+    except ValueError:
+        workers = 0
+    return workers if workers > 0 else (os.cpu_count() or 2)
 
-def extract_pdf_text(path: str) -> Tuple[str, str, str]:
+
+def _ocr_dpi() -> int:
+    # Grayscale pages at 200 DPI read as well as color ones for typical guide
+    # scans while giving tesseract far fewer bytes to preprocess.
+    try:
+        dpi = int(os.environ.get('OCR_DPI') or 0)
+    except ValueError:
+        dpi = 0
+    return dpi if dpi > 0 else 200
+
+
+def pdf_page_count(path: str) -> Tuple[int, str, str]:
     try:
         proc = subprocess.run(
-            ['pdftotext', '-enc', 'UTF-8', '-layout', path, '-'],
+            ['pdfinfo', path],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             check=True,
-            text=True,
         )
-        return proc.stdout or '', None, ''
     except FileNotFoundError:
-        return '', 'pdftotext_not_found', ''
+        return 0, 'pdfinfo_not_found', ''
     except subprocess.CalledProcessError as exc:
-        return exc.stdout or '', 'pdftotext_failed', (exc.stderr or '').strip()
+        return 0, 'pdfinfo_failed', _error_detail(exc)
+    for line in proc.stdout.decode('utf-8', errors='replace').splitlines():
+        key, _, value = line.partition(':')
+        if key.strip() == 'Pages':
+            try:
+                return int(value.strip()), None, ''
+            except ValueError:
+                break
+    return 0, 'pdfinfo_failed', 'pdfinfo did not report a page count'
 
 
-def extract_pdf_ocr(path: str) -> Tuple[List[str], str, str]:
+def _page_runs(page_numbers: List[int]) -> List[Tuple[int, int]]:
+    runs: List[Tuple[int, int]] = []
+    for number in page_numbers:
+        if runs and number == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], number)
+        else:
+            runs.append((number, number))
+    return runs
+
+
+@lru_cache(maxsize=None)
+def _scratch_dir() -> str:
+    # One scratch directory per process for rendered pages; files are removed
+    # individually after each shard instead of tearing down a directory tree.
+    configured = os.environ.get('OCR_SCRATCH')
+    if configured:
+        os.makedirs(configured, exist_ok=True)
+        return configured
+    path = tempfile.mkdtemp(prefix='ocrkb_')
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return path
+
+
+def _ocr_shard(path: str, page_numbers: List[int], page_count: int, scratch: str) -> Tuple[List[str], str, str]:
+    # Render the shard's pages, then OCR them all with a single tesseract run
+    # over an image list so the spa+eng models are loaded once per shard
+    # rather than once per page.
+    prefix = os.path.join(scratch, f'page_{os.getpid()}_{page_numbers[0]}')
+    list_path = f'{prefix}.list'
+    out_base = f'{prefix}.out'
+    # pdftoppm names pages <prefix>-<n>.png, zero-padded to the width of the
+    # document's page count, so the file names are known up front.
+    width = len(str(page_count))
+    images = [f'{prefix}-{number:0{width}d}.png' for number in page_numbers]
     try:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            prefix = os.path.join(tmpdir, 'page')
+        for first, last in _page_runs(page_numbers):
+            try:
+                subprocess.run(
+                    [
+                        'pdftoppm', '-f', str(first), '-l', str(last),
+                        '-r', str(_ocr_dpi()), '-gray', '-png', path, prefix,
+                    ],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                    check=True,
+                )
+            except FileNotFoundError:
+                return [], 'pdftoppm_not_found', ''
+            except subprocess.CalledProcessError as exc:
+                return [], 'pdftoppm_failed', _error_detail(exc)
+        if not os.path.isfile(images[-1]):
+            return [], 'pdftoppm_empty', f'pdftoppm did not produce {os.path.basename(images[-1])}'
+        with open(list_path, 'w', encoding='utf-8') as handle:
+            handle.write('\n'.join(images) + '\n')
+        try:
             subprocess.run(
-                ['pdftoppm', '-png', path, prefix],
-                stdout=subprocess.PIPE,
+                ['tesseract', list_path, out_base, '-l', 'spa+eng', 'txt'],
+                stdout=subprocess.DEVNULL,
                 stderr=subprocess.PIPE,
                 check=True,
-                text=True,
+                # Shards already run one tesseract per core; keep each one
+                # single-threaded so OpenMP does not oversubscribe the CPUs.
+                env={**os.environ, 'OMP_THREAD_LIMIT': '1'},
             )
-            images = sorted(glob.glob(f'{prefix}-*.png'))
-            if not images:
-                return [], 'pdftoppm_empty', 'pdftoppm produced no images'
-            pages: List[str] = []
-            for image_path in images:
-                try:
-                    tess = subprocess.run(
-                        ['tesseract', image_path, 'stdout', '-l', 'spa+eng'],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        check=True,
-                        text=True,
-                    )
-                    pages.append(tess.stdout or '')
-                except FileNotFoundError:
-                    return [], 'tesseract_not_found', ''
-                except subprocess.CalledProcessError as exc:
-                    return [], 'tesseract_failed', (exc.stderr or '').strip()
-            return pages, None, ''
-    except FileNotFoundError as exc:
-        missing = os.path.basename(getattr(exc, 'filename', '') or '') or 'pdftoppm'
-        return [], f'{missing}_not_found', ''
-    except subprocess.CalledProcessError as exc:
-        return [], 'pdftoppm_failed', (exc.stderr or '').strip()
+        except FileNotFoundError:
+            return [], 'tesseract_not_found', ''
+        except subprocess.CalledProcessError as exc:
+            return [], 'tesseract_failed', _error_detail(exc)
+        with open(f'{out_base}.txt', 'rb') as handle:
+            output = handle.read().decode('utf-8', errors='replace')
+    finally:
+        for produced in images + [list_path, f'{out_base}.txt']:
+            try:
+                os.unlink(produced)
+            except FileNotFoundError:
+                pass
+    # Tesseract separates the pages of a multi-image run with form feeds;
+    # depending on the version a trailing separator follows the last page.
+    pages = output.split('\f')
+    if len(pages) == len(page_numbers) + 1 and not pages[-1].strip():
+        pages.pop()
+    if len(pages) != len(page_numbers):
+        return [], 'tesseract_failed', f'tesseract returned {len(pages)} of {len(page_numbers)} pages'
+    return pages, None, ''
+
+
+def extract_pdf_ocr(path: str, page_numbers: Optional[List[int]] = None) -> Tuple[List[str], str, str]:
+    # OCR the given 1-based pages (every page when omitted); the returned
+    # texts line up with ``page_numbers``.
+    if page_numbers is not None and not page_numbers:
+        return [], None, ''
+    page_count, count_error, count_detail = pdf_page_count(path)
+    if count_error:
+        return [], count_error, count_detail
+    if page_count <= 0:
+        return [], 'pdftoppm_empty', 'pdfinfo reported no pages'
+    if page_numbers is None:
+        page_numbers = list(range(1, page_count + 1))
+    # Split the pages into one contiguous shard per worker. Each shard runs in
+    # its own pdftoppm/tesseract processes, so a thread pool is enough to keep
+    # every core busy; shards are collected back in page order.
+    workers = min(_ocr_workers(), len(page_numbers))
+    size = -(-len(page_numbers) // workers)
+    shards = [page_numbers[start:start + size] for start in range(0, len(page_numbers), size)]
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        scratch = _scratch_dir()
+        futures = [pool.submit(_ocr_shard, path, shard, page_count, scratch) for shard in shards]
+        pages: List[str] = []
+        for future in futures:
+            texts, error, detail = future.result()
+            if error:
+                for pending in futures:
+                    pending.cancel()
+                return [], error, detail
+            pages.extend(texts)
+    return pages, None, ''
 
 
 def extract_docx_pages(path: str) -> Tuple[List[str], str]:
     try:
-        with ZipFile(path) as zf:
-            xml = zf.read('word/document.xml')
+        zf = ZipFile(path)
     except FileNotFoundError:
         return [], 'docx_not_found'
-    except KeyError:
-        return [], 'document_xml_missing'
     except Exception as exc:
         return [], f'docx_read_error: {exc}'
-    try:
-        root = ET.fromstring(xml)
-    except Exception as exc:
-        return [], f'docx_parse_error: {exc}'
-    ns = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
-    t_tag = '{%s}t' % ns['w']
-    br_tag = '{%s}br' % ns['w']
-    type_attr = '{%s}type' % ns['w']
     pages: List[str] = []
     current: List[str] = []
-    for para in root.findall('.//w:p', ns):
-        texts: List[str] = []
-        page_break = False
-        for node in para.iter():
-            if node.tag == t_tag and node.text:
-                texts.append(node.text)
-            elif node.tag == br_tag and node.attrib.get(type_attr) == 'page':
-                page_break = True
-        paragraph = ' '.join(texts).strip()
-        if paragraph:
-            current.append(paragraph)
-        if page_break:
-            combined = '\n'.join(current).strip()
-            if combined:
-                pages.append(combined)
-            current = []
+    # One [texts, page_break, nested] entry per open w:p. Paragraphs can nest
+    # (text boxes), so runs and breaks belong to the innermost open one; a
+    # nested paragraph is emitted after the paragraph that contains it.
+    open_paragraphs: List[list] = []
+    with zf:
+        try:
+            stream = zf.open('word/document.xml')
+        except KeyError:
+            return [], 'document_xml_missing'
+        except Exception as exc:
+            return [], f'docx_read_error: {exc}'
+        # Parse incrementally in a single pass, classifying each element by
+        # tag: runs of text accumulate until their paragraph closes, and
+        # finished body children are dropped as we go.
+        with stream:
+            try:
+                depth = 0
+                body = None
+                for event, elem in ET.iterparse(stream, events=('start', 'end')):
+                    if event == 'start':
+                        depth += 1
+                        if depth == 2:
+                            body = elem
+                        elif elem.tag == _P_TAG:
+                            open_paragraphs.append([[], False, []])
+                        continue
+                    depth -= 1
+                    tag = elem.tag
+                    if tag == _T_TAG:
+                        if elem.text and open_paragraphs:
+                            open_paragraphs[-1][0].append(elem.text)
+                    elif tag == _BR_TAG:
+                        if elem.attrib.get(_TYPE_ATTR) == 'page' and open_paragraphs:
+                            open_paragraphs[-1][1] = True
+                    elif tag == _P_TAG and open_paragraphs:
+                        texts, page_break, nested = open_paragraphs.pop()
+                        finished = [(' '.join(texts).strip(), page_break)] + nested
+                        elem.clear()
+                        if open_paragraphs:
+                            open_paragraphs[-1][2].extend(finished)
+                            continue
+                        for paragraph, page_break in finished:
+                            if paragraph:
+                                current.append(paragraph)
+                            if page_break:
+                                combined = '\n'.join(current).strip()
+                                if combined:
+                                    pages.append(combined)
+                                current = []
+                    if depth == 2 and body is not None:
+                        body.clear()
+            except ET.ParseError as exc:
+                return [], f'docx_parse_error: {exc}'
+            except Exception as exc:
+                return [], f'docx_read_error: {exc}'
     remaining = '\n'.join(current).strip()
     if remaining:
         pages.append(remaining)
-    if not pages:
-        all_paragraphs = []
-        for para in root.findall('.//w:p', ns):
-            texts = [node.text for node in para.findall('.//w:t', ns) if node.text]
-            if texts:
-                all_paragraphs.append(' '.join(texts))
-        joined = '\n'.join(all_paragraphs).strip()
-        if joined:
-            pages.append(joined)
     return pages, None
 
 def process_document(meta: dict) -> dict:
@@ -237,7 +507,6 @@ def process_document(meta: dict) -> dict:
                 "status": "error",
             }],
             "page_count": 0,
-            "text_length": 0,
             "extraction": {
                 "method": None,
                 "used_ocr": False,
@@ -251,23 +520,38 @@ def process_document(meta: dict) -> dict:
     ocr_used = False
     errors = {}
     if extension == 'pdf':
-        text, pdf_error, pdf_detail = extract_pdf_text(path)
-        if pdf_error:
-            errors['pdftotext'] = pdf_error
-            if pdf_detail:
-                errors['pdftotext_detail'] = pdf_detail
-        if text and text.strip():
-            pages = [page for page in text.split('\f') if page and page.strip()]
-            extraction_method = 'pdftotext'
-        else:
-            pages, ocr_error, ocr_detail = extract_pdf_ocr(path)
+        text, text_method, text_errors = extract_pdf_text(path)
+        errors.update(text_errors)
+        # Keep the text layer for born-digital pages and OCR only the pages
+        # where it is missing or too thin (scans inside mixed PDFs).
+        pages = text.split('\f') if text else []
+        need_ocr = [index for index, page in enumerate(pages) if len(page.strip()) < OCR_MIN_CHARS]
+        if any(page.strip() for page in pages):
+            extraction_method = text_method
+        if not pages or need_ocr:
+            page_numbers = [index + 1 for index in need_ocr] if pages else None
+            ocr_pages, ocr_error, ocr_detail = extract_pdf_ocr(path, page_numbers)
             if ocr_error:
-                errors['ocr'] = ocr_error
+                # When only some pages needed OCR the document still has its
+                # text layer, so the failure is reported as partial.
+                key = 'ocr_partial' if 0 < len(need_ocr) < len(pages) else 'ocr'
+                errors[key] = ocr_error
                 if ocr_detail:
-                    errors['ocr_detail'] = ocr_detail
-            if pages:
-                extraction_method = 'tesseract'
-                ocr_used = True
+                    errors[f'{key}_detail'] = ocr_detail
+            elif not pages:
+                pages = ocr_pages
+                if pages:
+                    extraction_method = 'tesseract'
+                    ocr_used = True
+            else:
+                replaced = 0
+                for index, ocr_text in zip(need_ocr, ocr_pages):
+                    if len(ocr_text.strip()) > len(pages[index].strip()):
+                        pages[index] = ocr_text
+                        replaced += 1
+                if replaced:
+                    extraction_method = f'{extraction_method}+tesseract' if extraction_method else 'tesseract'
+                    ocr_used = True
     elif extension == 'docx':
         pages, docx_error = extract_docx_pages(path)
         if docx_error:
@@ -277,33 +561,9 @@ def process_document(meta: dict) -> dict:
         errors['unsupported'] = f'Formato no soportado: {extension}'
     else:
         errors['unsupported'] = f'Formato no soportado: {extension or "desconocido"}'
-    page_count = len(pages)
-    chunks = chunk_pages(pages) if pages else []
-    if not chunks:
-        if errors.get('unsupported'):
-            message = errors['unsupported']
-        elif extension == 'pdf':
-            if errors.get('ocr'):
-                message = f"[ERROR] OCR falló: {errors['ocr']}"
-            elif errors.get('pdftotext'):
-                message = f"[ERROR] pdftotext falló: {errors['pdftotext']}"
-            else:
-                message = 'No se encontró texto legible en el PDF.'
-        elif extension == 'docx':
-            message = f"No se pudo interpretar el DOCX: {errors.get('docx', 'desconocido')}"
-        else:
-            message = 'No se pudo extraer texto del documento.'
-        chunks = [{
-            "chunk_index": 1,
-            "page_number": 1,
-            "content": message,
-            "status": "error",
-        }]
-    text_length = sum(len(chunk.get('content') or '') for chunk in chunks if chunk.get('status') == 'ok')
     result.update({
-        "chunks": chunks,
-        "page_count": page_count,
-        "text_length": text_length,
+        "chunks": document_chunks(pages, extension, errors),
+        "page_count": len(pages),
         "extraction": {
             "method": extraction_method,
             "used_ocr": ocr_used,
@@ -312,10 +572,124 @@ def process_document(meta: dict) -> dict:
     })
     return result
 
+
+def document_chunks(pages: List[str], extension: str, errors: dict) -> Iterator[dict]:
+    emitted = False
+    for chunk in chunk_pages(pages):
+        emitted = True
+        yield chunk
+    if emitted:
+        return
+    if errors.get('unsupported'):
+        message = errors['unsupported']
+    elif extension == 'pdf':
+        if errors.get('ocr'):
+            message = f"[ERROR] OCR falló: {errors['ocr']}"
+        elif errors.get('pdftotext'):
+            message = f"[ERROR] pdftotext falló: {errors['pdftotext']}"
+        else:
+            message = 'No se encontró texto legible en el PDF.'
+    elif extension == 'docx':
+        message = f"No se pudo interpretar el DOCX: {errors.get('docx', 'desconocido')}"
+    else:
+        message = 'No se pudo extraer texto del documento.'
+    yield {
+        "chunk_index": 1,
+        "page_number": 1,
+        "content": message,
+        "status": "error",
+    }
+
+
+def failed_result(meta, exc: Exception) -> dict:
+    # Result line for a document that could not be processed at all, so one
+    # bad metadata line does not stop the rest of an NDJSON batch.
+    info = meta if isinstance(meta, dict) else {}
+    # Same normalization as process_document, but never raising: the id links
+    # the error row back to its source.
+    raw_id = info.get('source_id')
+    try:
+        source_id = -1 if isinstance(raw_id, bool) else int(raw_id or -1)
+    except (TypeError, ValueError):
+        source_id = -1
+    return {
+        "source_id": source_id if source_id >= 0 else -1,
+        "source_name": str(info.get('source_name') or '').strip() or 'documento',
+        "file_name": info.get('file_name') or 'documento',
+        "file_path": info.get('file_path'),
+        "dest_path": info.get('dest_path'),
+        "source_path": info.get('source_path') or info.get('dest_path'),
+        "extension": str(info.get('extension') or '').lower(),
+        "chunks": [{
+            "chunk_index": 1,
+            "page_number": 1,
+            "content": f"[ERROR] No se pudo procesar el documento: {exc}",
+            "status": "error",
+        }],
+        "page_count": 0,
+        "extraction": {
+            "method": None,
+            "used_ocr": False,
+            "errors": {"document": f'{type(exc).__name__}: {exc}'},
+        },
+    }
+
+
+def write_result(result: dict, out: IO[str]) -> None:
+    # Same JSON object as json.dumps(result), but chunks are serialized one at
+    # a time as they are produced and text_length is summed along the way.
+    tail_keys = ('chunks', 'page_count', 'text_length', 'extraction')
+    head = {key: value for key, value in result.items() if key not in tail_keys}
+    out.write(json.dumps(head, ensure_ascii=False)[:-1])
+    out.write(', "chunks": [')
+    text_length = 0
+    position = 0
+    try:
+        for chunk in result.get('chunks') or []:
+            if position:
+                out.write(', ')
+            out.write(json.dumps(chunk, ensure_ascii=False))
+            position += 1
+            if chunk.get('status') == 'ok':
+                text_length += len(chunk.get('content') or '')
+    except Exception as exc:
+        # Part of the object is already written: close it with an error chunk
+        # so the line stays valid JSON.
+        if position:
+            out.write(', ')
+        out.write(json.dumps({
+            "chunk_index": position + 1,
+            "page_number": 1,
+            "content": f"[ERROR] No se pudo procesar el documento: {exc}",
+            "status": "error",
+        }, ensure_ascii=False))
+        errors = (result.get('extraction') or {}).get('errors')
+        if isinstance(errors, dict):
+            errors['chunking'] = f'{type(exc).__name__}: {exc}'
+    tail = {
+        "page_count": result.get('page_count', 0),
+        "text_length": text_length,
+        "extraction": result.get('extraction'),
+    }
+    out.write('], ')
+    out.write(json.dumps(tail, ensure_ascii=False)[1:])
+
+
 def main() -> None:
-    meta = load_metadata()
-    result = process_document(meta)
-    print(json.dumps(result, ensure_ascii=False))
+    # Each document's result is written as one line and flushed right away,
+    # so a caller streaming NDJSON in can consume results as they complete.
+    with open(sys.stdout.fileno(), 'w', encoding='utf-8', buffering=65536, closefd=False) as out:
+        for meta in load_metadata():
+            if isinstance(meta, json.JSONDecodeError):
+                result = failed_result(None, meta)
+            else:
+                try:
+                    result = process_document(meta)
+                except Exception as exc:
+                    result = failed_result(meta, exc)
+            write_result(result, out)
+            out.write('\n')
+            out.flush()
 
 
 if __name__ == '__main__':